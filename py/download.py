@@ -1,8 +1,7 @@
-import boto3
 import os
 import subprocess
 from filetypes import get_filetype
-from helpers import check_file_exists
+from helpers import check_file_exists, get_s3_client, append_unique_lines, iter_objects
 from warnings import warn
 
 def download(locations, filenames, inbucket, use_slurm=False, account="", requester_pays=False):
@@ -15,12 +14,8 @@ def download(locations, filenames, inbucket, use_slurm=False, account="", reques
     """
     ftype, idx_ext = get_filetype(locations)
 
-    s3_client = boto3.client("s3")
-    response = s3_client.list_objects_v2(Bucket="niagads-bucket", Prefix=f"{ftype}s/")
-
-    existing_files = []
-    if "Contents" in response:
-        existing_files = [obj["Key"].split("/")[-1] for obj in response["Contents"]]
+    s3_client = get_s3_client()
+    existing_files = {obj["Key"].split("/")[-1] for obj in iter_objects(s3_client, "niagads-bucket", f"{ftype}s/")}
 
     failed_subjects = set()  # To store the subjects that failed to download
 
@@ -69,14 +64,6 @@ aws s3 cp {slurm_insert}"{loc}" "s3://{inbucket}/{ftype}s/{file}"
                 os.remove(slurm_script_file)
 
     # Append the failed subjects to the file
-    with open("failed_downloads.txt", "a") as file:
-        file.write("\n".join(failed_subjects) + "\n")
-    
-    # Remove duplicates from the file
-    lines = set()
-    with open("failed_downloads.txt", "r") as file:
-        lines = file.readlines()
-    with open("failed_downloads.txt", "w") as file:
-        file.writelines(set(lines))
+    append_unique_lines("failed_downloads.txt", failed_subjects)
     
     print("Submissions complete.")
\ No newline at end of file
@@ -3,57 +3,182 @@ import csv
 import re
 import sys
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 from warnings import warn
 from filetypes import get_filetype
 
+# sized for the thread pools below; adaptive retries absorb 503 SlowDown under load
+_S3_CONFIG = Config(max_pool_connections=128, retries={'mode': 'adaptive', 'max_attempts': 8}, tcp_keepalive=True)
+_S3_CLIENT = None
 
-def file_in_failed(subject, try_again=False):
+# (bucket, prefix) -> complete listings made in this process
+_LISTING_CACHE = {}
+
+# filename -> basename without extension, reused when a file appears in several batches
+_BASENAME_CACHE = {}
+
+
+def get_s3_client():
     """
-    Check if a subject is present in the "failed_downloads.txt" file.
+    return the S3 client shared by all helpers, creating it on first use
+    (clients are thread-safe, so the thread pools below share it too)
+    """
+    global _S3_CLIENT
+    if _S3_CLIENT is None:
+        _S3_CLIENT = boto3.client('s3', config=_S3_CONFIG)
+    return _S3_CLIENT
+
+
+def load_failed(try_again=False):
+    """
+    Load the subjects listed in "failed_downloads.txt" (and "failed_runs.txt"
+    unless try_again) so they can be checked with a set lookup.
 
     Args:
-    subject (str): The subject to check.
+    try_again (bool): ignore "failed_runs.txt" if True
 
     Returns:
-    bool: True if the subject is present in "failed.txt", False otherwise.
+    frozenset: subjects that previously failed.
     """
-    if not os.path.exists('failed_runs.txt'):
-        with open('failed_runs.txt', 'w') as f:
-            pass
-    if not os.path.exists('failed_downloads.txt'):
-        with open('failed_downloads.txt', 'w') as f:
-            pass
-    with open("failed_downloads.txt", "r") as file:
-        for line in file:
-            if line.strip() == subject:
-                return True
+    paths = ["failed_downloads.txt"]
     if not try_again:
-        with open("failed_runs.txt", "r") as file:
-            for line in file:
-                if line.strip() == subject:
-                    return True
-    return False
+        paths.append("failed_runs.txt")
+
+    failed = set()
+    for path in paths:
+        try:
+            with open(path, "r") as file:
+                failed.update(line.strip() for line in file)
+        except FileNotFoundError:
+            pass
+
+    return frozenset(failed)
+
+
+def append_unique_lines(path, lines):
+    """
+    append lines to a text file, skipping any already present in it
+    (creates the file if it does not exist)
+    """
+    seen = set()
+    if os.path.exists(path):
+        with open(path, "r") as file:
+            seen = {line.strip() for line in file}
+
+    with open(path, "a") as file:
+        for line in lines:
+            if line and line not in seen:
+                file.write(line + "\n")
+                seen.add(line)
+
+
+def iter_objects(s3_client, bucket, prefix):
+    """
+    yield every object under prefix, following list_objects_v2 pagination
+    (a single call is capped at 1000 keys)
+    """
+    paginator = s3_client.get_paginator('list_objects_v2')
+    pages = paginator.paginate(Bucket=bucket, Prefix=prefix, PaginationConfig={'PageSize': 1000})
+    for page in pages:
+        for obj in page.get('Contents', []):
+            yield obj
+
+
+def cached_list(s3_client, bucket, prefix):
+    """
+    yield every object under prefix, listing the bucket only the first time
+    in this process. The cache lives in memory only, so each scheduler run
+    starts from a fresh listing and sees every output written before it.
+    A listing that is stopped early is not cached.
+    """
+    if (bucket, prefix) in _LISTING_CACHE:
+        yield from _LISTING_CACHE[(bucket, prefix)]
+        return
+
+    objects = []
+    for obj in iter_objects(s3_client, bucket, prefix):
+        objects.append(obj)
+        yield obj
+    _LISTING_CACHE[(bucket, prefix)] = objects
 
 
-def get_subject_completed_set(outbucket, prefix):
+def delete_keys(s3_client, bucket, keys):
     """
-    check output bucket for completed subjects and return list them
+    delete keys from bucket in batches of 1000 (the delete_objects limit)
+    and return the per-key errors reported by S3
     """
-    s3_client = boto3.client('s3')
-    response = s3_client.list_objects_v2(Bucket=outbucket, Prefix=prefix)
+    errors = []
+    for i in range(0, len(keys), 1000):
+        chunk = keys[i:i+1000]
+        response = s3_client.delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': k} for k in chunk], 'Quiet': True})
+        errors.extend(response.get('Errors', []))
+
+    return errors
+
+
+def move_objects(s3_client, bucket, moves, max_workers=64):
+    """
+    move objects within a bucket, copying in parallel and then deleting
+    the sources that were copied in batches
+
+    args
+    moves (list[tuple[str, str]]): (source key, destination key) pairs
+    max_workers (int): number of concurrent copy requests
+    """
+    def copy_one(move):
+        source_key, new_key = move
+        try:
+            s3_client.copy_object(Bucket=bucket, Key=new_key, CopySource={'Bucket': bucket, 'Key': source_key})
+        except ClientError as e:
+            warn(f"Could not copy s3://{bucket}/{source_key} to s3://{bucket}/{new_key} ({e})")
+            return None
+        return source_key
+
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        copied_keys = [key for key in ex.map(copy_one, moves) if key is not None]
+
+    for error in delete_keys(s3_client, bucket, copied_keys):
+        warn(f"Could not delete s3://{bucket}/{error['Key']} ({error.get('Code')}: {error.get('Message')})")
+
+
+def iter_completed_subjects(outbucket, prefix, tar_prefix=None):
+    """
+    lazily yield completed subjects from the output bucket, reusing a listing
+    already made by this process
+
+    args
+    tar_prefix (str): prefix holding only the output tars; listed instead of
+        prefix so S3 returns no other keys
+    """
+    s3_client = get_s3_client()
+    list_prefix = tar_prefix or prefix
+    for obj in cached_list(s3_client, outbucket, list_prefix):
+        key = obj['Key']
+        if tar_prefix or key.endswith('.tar'):
+            for s in key.split(".tar", 1)[0].split("___"):
+                yield s.rpartition('/')[2]
+
+
+def get_subject_completed_set(outbucket, prefix, subjects, tar_prefix=None):
+    """
+    return which of the given subjects have outputs in the output bucket,
+    stopping the listing as soon as all of them have been found
+    """
+    remaining = set(subjects)
     completed_set = set()
-    if 'Contents' in response:
-        for obj in response['Contents']:
-            if obj['Key'].endswith('.tar'):
-                #subj = extract_subjects(str(obj['Key']))
-                subj = str(obj['Key']).split(".tar")[0].split("___")
-                for s in subj:
-                    completed_set.add(s.split('/')[-1])
+    for item in iter_completed_subjects(outbucket, prefix, tar_prefix=tar_prefix):
+        found = {subject for subject in remaining if subject in item}
+        completed_set |= found
+        remaining -= found
+        if not remaining:
+            break
 
     return completed_set
 
 
-def resolve_inputs(csv_file, batch_size, outbucket, cores_per_inst, prefix, allow_existing=False, exclude_failed=False, try_again=False):
+def resolve_inputs(csv_file, batch_size, outbucket, cores_per_inst, prefix, allow_existing=False, exclude_failed=False, try_again=False, tar_prefix=None):
     """
     takes a csv file with columns location, Subject to populate lists of each one
     constrained by other args
@@ -63,60 +188,65 @@ def resolve_inputs(csv_file, batch_size, outbucket, cores_per_inst, prefix, allo
     batch_size (int): max size to process at a time
     allow_existing (bool): excludes samples whose outputs are in the outbucket if false
     exclude_failed (bool): excludes files present in "failed.txt" if True
+    tar_prefix (str): optional outbucket prefix holding only output tars
     """
     with open(csv_file, 'r') as file:
-        reader = csv.DictReader(file)
-        locations = []
-        completed_set = get_subject_completed_set(outbucket, prefix=prefix) if not allow_existing else {}
-
-        for row in reader:
-            if not any(row['Subject'] in item for item in completed_set):
-                location = row['location']
-                if exclude_failed and file_in_failed(row['Subject'], try_again=try_again):
-                    print(f"Skipping file for subject {row['Subject']} due to previous failure.")
-                else:
-                    locations.append(location)
+        reader = csv.reader(file)
+        header = next(reader)
+        li = header.index('location')
+        si = header.index('Subject')
+        rows = [row for row in reader if row]  # skip blank lines like DictReader
+
+    locations = []
+    completed_set = get_subject_completed_set(outbucket, prefix, {row[si] for row in rows}, tar_prefix=tar_prefix) if not allow_existing else set()
+    failed_set = load_failed(try_again=try_again) if exclude_failed else frozenset()
+
+    # largest multiple of cores_per_inst that fits in the batch
+    effective_cap = batch_size - (batch_size % cores_per_inst) if batch_size is not None else None
+
+    for row in rows:
+        if len(locations) == effective_cap:
+            break
+        subject = row[si]
+        if subject not in completed_set:
+            if subject in failed_set:
+                print(f"Skipping file for subject {subject} due to previous failure.")
             else:
-                print(row['Subject'], " has already been called, skipping!")
-            if len(locations) == batch_size:
-                break
+                locations.append(row[li])
+        else:
+            print(subject, " has already been called, skipping!")
 
     # Adjusting locations to be a multiple of cores_per_inst
+    # (only trims when the csv ran out before the cap was reached)
     locations = locations[:len(locations) - (len(locations) % cores_per_inst)]
-    filenames = [loc.split("/")[-1] for loc in locations]
+    filenames = [loc.rpartition("/")[2] for loc in locations]
 
     return locations, filenames
 
 
-def prepend_path(nested_list, path):
+def chunk_list(items, size):
     """
-    adds a specified path to a nested list of files
-
-    args
-    nested_list (list): nested list of any size
-    path (str): path to prepend
+    split a flat list into consecutive lists of at most size items
     """
-    if isinstance(nested_list, str):
-        return path + nested_list
-    else:
-        return [prepend_path(item, path) for item in nested_list]
-    
+    return [items[i:i+size] for i in range(0, len(items), size)]
 
-def basename(nested_list):
+
+def subject_name(filename):
     """
-    convert nested list of files to nest list of their basenames
+    basename of filename without its extension, memoized in _BASENAME_CACHE
     """
-    if isinstance(nested_list, str):
-        return os.path.splitext(os.path.basename(nested_list))[0]
-    else:
-        return [basename(item) for item in nested_list]
+    name = _BASENAME_CACHE.get(filename)
+    if name is None:
+        name = _BASENAME_CACHE[filename] = os.path.splitext(filename.rpartition("/")[2])[0]
+    return name
+
 
 def extract_subjects(nested_list):
     """
     Extract subject name from NIAGADS location string.
     """
     if isinstance(nested_list, str):
-        return "-".join(nested_list.split("_")[0].split("-")[:3])
+        return "-".join(nested_list.partition("_")[0].split("-", 3)[:3])
     else:
         return [extract_subjects(item) for item in nested_list]
 
@@ -130,54 +260,50 @@ def group_inputs(filenames, items_per_list):
     items_per_list (int): size of nested list
     """
     ftype, idx_ext = get_filetype(filenames)
-    
-    grouped_inputs = [filenames[i:i+items_per_list] for i in range(0, len(filenames), items_per_list)]
-    grouped_input_paths = prepend_path(grouped_inputs, f"{ftype}s/")
-    subjects = basename(grouped_inputs)
+
+    # build each flat list in one pass, then reshape
+    input_paths = [f"{ftype}s/{file}" for file in filenames]
+    subjects = [subject_name(file) for file in filenames]
+    subject_ids = extract_subjects(subjects)
+
+    grouped_input_paths = chunk_list(input_paths, items_per_list)
     if idx_ext:
-        idx_filenames = [file + "." + idx_ext for file in filenames]
-        grouped_idx = [idx_filenames[i:i+items_per_list] for i in range(0, len(filenames), items_per_list)] 
-        grouped_idx_paths = prepend_path(grouped_idx, f"{ftype}sidx/")
+        grouped_idx_paths = chunk_list([f"{ftype}sidx/{file}.{idx_ext}" for file in filenames], items_per_list)
     else:
         grouped_idx_paths = None
 
-    subject_ids = extract_subjects(subjects)
-
-    return subjects, subject_ids, grouped_input_paths, grouped_idx_paths
+    return chunk_list(subjects, items_per_list), chunk_list(subject_ids, items_per_list), grouped_input_paths, grouped_idx_paths
 
 
 def check_file_exists(bucket_name, file_key):
     """
     check if specfied file exists in a bucket
     """
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(bucket_name)
-    for obj in bucket.objects.filter(Prefix=file_key):
-        if obj.key == file_key:
-            return True
-    
-    return False
+    s3 = get_s3_client()
+    try:
+        s3.head_object(Bucket=bucket_name, Key=file_key)
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            return False
+        raise
 
 
 def move_logs_to_folder(jobid_prefix, outbucket):
     """
     move log files to folder matching their job_id prefix
     """
-    s3 = boto3.client('s3')
+    s3 = get_s3_client()
 
     # Create the folder in the root of the S3 bucket
     s3.put_object(Bucket=outbucket, Key=f"{jobid_prefix}/")
 
     # List all objects in the bucket with the specified prefix
-    response = s3.list_objects_v2(Bucket=outbucket, Prefix=f"{jobid_prefix}.")
+    # (collected up front so the listing is not affected by the moves)
+    files = [obj['Key'] for obj in iter_objects(s3, outbucket, f"{jobid_prefix}.")]
 
-    if 'Contents' in response:
-        # Move each file with the specified prefix to the folder
-        for file in response['Contents']:
-            file_name = file['Key']
-            new_key = f"{jobid_prefix}/{file_name}"
-            s3.copy_object(Bucket=outbucket, Key=new_key, CopySource={'Bucket': outbucket, 'Key': file_name})
-            s3.delete_object(Bucket=outbucket, Key=file_name)
+    # Move each file with the specified prefix to the folder
+    move_objects(s3, outbucket, [(file_name, f"{jobid_prefix}/{file_name}") for file_name in files])
 
     print(f"{jobid_prefix} logs consolidated successfully.")
 
@@ -187,17 +313,31 @@ def remove_inputs_from_file(filenames, inbucket):
     remove cwl input files from inbucket based on given csv-file
     """
     ftype, idx_ext = get_filetype(filenames)
-    s3 = boto3.client('s3')
-    for file in filenames:
+    s3 = get_s3_client()
+    keys = [f"{ftype}s/{file}" for file in filenames]
+    if idx_ext:
+        keys += [f"{ftype}sidx/{file}.{idx_ext}" for file in filenames]
+
+    # delete_objects reports missing keys as deleted, so check for them first
+    def check_one(key):
         try:
-            s3.delete_object(Bucket=inbucket, Key=f"{ftype}s/{file}")
-        except:
-            warn(f"Could not find s3://{inbucket}/{ftype}s/{file}")
-        if idx_ext:
-            try:
-                s3.delete_object(Bucket=inbucket, Key=f"{ftype}sidx/{file}.{idx_ext}")
-            except:
-                warn(f"Could not find s3://{inbucket}/{ftype}sidx/{file}.{idx_ext}")
+            return check_file_exists(inbucket, key)
+        except ClientError as e:
+            # e.g. 403 for a missing key without s3:ListBucket
+            warn(f"Could not check s3://{inbucket}/{key} ({e}), skipping")
+            return None
+
+    with ThreadPoolExecutor(max_workers=32) as ex:
+        exists = list(ex.map(check_one, keys))
+    present = []
+    for key, found in zip(keys, exists):
+        if found:
+            present.append(key)
+        elif found is False:
+            warn(f"Could not find s3://{inbucket}/{key}")
+
+    for error in delete_keys(s3, inbucket, present):
+        warn(f"Could not delete s3://{inbucket}/{error['Key']} ({error.get('Code')}: {error.get('Message')})")
     print("File deletion complete.")
 
 
@@ -206,18 +346,13 @@ def move_logs_to_root(jobid_prefix, outbucket):
     move log files back to root 
     (neccessary for tibanna to find them!)
     """
-    s3 = boto3.client('s3')
+    s3 = get_s3_client()
 
     # List all objects in the specified folder
-    response = s3.list_objects_v2(Bucket=outbucket, Prefix=f"{jobid_prefix}/{jobid_prefix}.")
+    files = [obj['Key'] for obj in iter_objects(s3, outbucket, f"{jobid_prefix}/{jobid_prefix}.")]
 
-    if 'Contents' in response:
-        # Move each file to the root directory
-        for file in response['Contents']:
-            file_name = file['Key']
-            new_key = os.path.basename(file_name)
-            s3.copy_object(Bucket=outbucket, Key=new_key, CopySource={'Bucket': outbucket, 'Key': file_name})
-            s3.delete_object(Bucket=outbucket, Key=file_name)
+    # Move each file to the root directory
+    move_objects(s3, outbucket, [(file_name, os.path.basename(file_name)) for file_name in files])
 
     print(f"{jobid_prefix} logs moved to root directory successfully.")
 
@@ -226,13 +361,12 @@ def remove_all_inputs(inbucket, dirs=["cramsidx", "crams"]):
     """
     remove ALL cwl input files from inbucket 
     """
-    s3 = boto3.client('s3')
+    s3 = get_s3_client()
     for dir in dirs:
-        response = s3.list_objects_v2(Bucket=inbucket, Prefix=dir)
-        if 'Contents' in response:
-            # Delete each file in the folder
-            objects = [{'Key': obj['Key']} for obj in response['Contents']]
-            s3.delete_objects(Bucket=inbucket, Delete={'Objects': objects})
+        # Delete each file in the folder, in batches of 1000
+        keys = [obj['Key'] for obj in iter_objects(s3, inbucket, dir)]
+        for error in delete_keys(s3, inbucket, keys):
+            warn(f"Could not delete s3://{inbucket}/{error['Key']} ({error.get('Code')}: {error.get('Message')})")
 
     print("Successfully removed all input files!")
 
@@ -241,14 +375,11 @@ def get_unique_job_ids_from_s3_bucket(bucket_name, jobid_prefix):
     """
     return unique job ids with the jobid_prefix
     """
-    s3 = boto3.client('s3')
-
-    # List objects in the S3 bucket
-    response = s3.list_objects_v2(Bucket=bucket_name, Prefix=jobid_prefix)
+    s3 = get_s3_client()
 
     # Extract unique job IDs based on the specified pattern
     job_ids = set()
-    for obj in response['Contents']:
+    for obj in iter_objects(s3, bucket_name, jobid_prefix):
         key = obj['Key']
         if key.endswith('.postrun.json'):
             job_id = key.split('.postrun.json')[0]
@@ -257,6 +388,37 @@ def get_unique_job_ids_from_s3_bucket(bucket_name, jobid_prefix):
     return list(job_ids)
 
 
+def postrun_has_md5(s3_client, bucket, key, size, head_bytes=65536):
+    """
+    check whether a .postrun.json file contains the "md5sum" string,
+    reading only its first head_bytes and fetching the rest if not found there
+
+    Files up to twice head_bytes are read with one plain GET. For larger
+    files with the marker past the first range this costs two requests and
+    nearly the whole body, slightly more than a single full GET.
+
+    args
+    size (int): object size in bytes, as reported by the listing
+    head_bytes (int): size of the first ranged GET
+    """
+    marker = b'"md5sum":'
+    # empty files have no md5sum, and S3 rejects a ranged GET on them
+    if size == 0:
+        return False
+    if size <= 2 * head_bytes:
+        response = s3_client.get_object(Bucket=bucket, Key=key)
+        return marker in response['Body'].read()
+
+    response = s3_client.get_object(Bucket=bucket, Key=key, Range=f"bytes=0-{head_bytes - 1}")
+    if marker in response['Body'].read():
+        return True
+
+    # overlap the ranges so a marker split across them is still found
+    start = head_bytes - len(marker) + 1
+    response = s3_client.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-")
+    return marker in response['Body'].read()
+
+
 def process_postrun_files(jobid_prefix, outbucket):
     """
     check post run for the md5sum substring to deteermine which runs did not complete
@@ -264,15 +426,13 @@ def process_postrun_files(jobid_prefix, outbucket):
     # Move jib id associated logs to root (necessary for tibanna to find)
     move_logs_to_root(jobid_prefix, outbucket)
 
-    s3 = boto3.client('s3')
+    s3 = get_s3_client()
     
-    # List objects in the S3 bucket with the specified prefix
-    response = s3.list_objects_v2(Bucket=outbucket, Prefix=f"{jobid_prefix}.")
-
-    failed_job_ids = set()  # Set to store failed job IDs
     spot_failures = set()
+    postrun_files = []
     tot=0
-    for obj in response.get('Contents', []):
+    # List objects in the S3 bucket with the specified prefix
+    for obj in iter_objects(s3, outbucket, f"{jobid_prefix}."):
         key = obj['Key']
         if key.endswith('.spot_failure'):
             tot+=1
@@ -283,58 +443,36 @@ def process_postrun_files(jobid_prefix, outbucket):
             continue
         if key.endswith('.postrun.json'):
             tot+=1
-            # Read the content of the .postrun.json file
-            response = s3.get_object(Bucket=outbucket, Key=key)
-            content = response['Body'].read().decode('utf-8')
-
-            # Check if the content contains the "md5sum" string
-            if '"md5sum":' not in content:
-                # Extract the job ID from the key
-                job_id = key.split('.postrun.json')[0]
-                samp_str = job_id.split(f"{jobid_prefix}.")[-1]
-                for samp in samp_str.split("._."):
-                    failed_job_ids.add(job_id)
+            postrun_files.append(obj)
+
+    def check_md5(obj):
+        # Check if the .postrun.json file contains the "md5sum" string,
+        # returning the job ID if it does not
+        if not postrun_has_md5(s3, outbucket, obj['Key'], obj['Size']):
+            return obj['Key'].split('.postrun.json')[0]
+        return None
+
+    with ThreadPoolExecutor(max_workers=32) as ex:
+        results = list(ex.map(check_md5, postrun_files))
+    failed_job_ids = {job_id for job_id in results if job_id}  # Set to store failed job IDs
 
     print(f"Failed to complete {len(spot_failures)}/{tot} jobs due to spot failures and {len(failed_job_ids)}/{tot} jobs for other reasons in the {jobid_prefix} batch! (or still running)")
     
     
     # Append failed job IDs to the output file
-    with open('failed_runs.txt', 'a') as f:
-        for job_id in failed_job_ids:
-            f.write(job_id + '\n')
-    
-    if not os.path.exists('failed_runs.txt'):
-        with open('failed_runs.txt', 'w') as f:
-            pass
+    append_unique_lines('failed_runs.txt', failed_job_ids)
 
-    # Remove duplicates from the file
-    lines = set()
-    with open("failed_runs.txt", "r") as file:
-        lines = file.readlines()
-    with open("failed_runs.txt", "w") as file:
-        file.writelines(set(lines))
-   
-        # Append failed (spot) job IDs to the output file
-    with open('spot_failures.txt', 'a') as f:
-        for job_id in spot_failures:
-            f.write(job_id + '\n')
-
-    # Remove duplicates from the file
-    lines = set()
-    with open("spot_failures.txt", "r") as file:
-        lines = file.readlines()
-    with open("spot_failures.txt", "w") as file:
-        file.writelines(set(lines))
+    # Append failed (spot) job IDs to the output file
+    append_unique_lines('spot_failures.txt', spot_failures)
 
     # move jid associated logs back to folder
     move_logs_to_folder(jobid_prefix, outbucket)
 
 def move_files_between_s3_buckets(source_bucket, source_prefix, destination_bucket, destination_prefix):
-    s3 = boto3.client('s3')
+    s3 = get_s3_client()
 
     # List objects in the source bucket with the specified prefix
-    response = s3.list_objects_v2(Bucket=source_bucket, Prefix=source_prefix)
-    objects = response['Contents']
+    objects = list(iter_objects(s3, source_bucket, source_prefix))
 
     # Move each object to the destination bucket
     for obj in objects:
@@ -26,6 +26,7 @@ if __name__ == "__main__":
     parser.add_argument("--requester-pays", dest="requester_pays", action="store_true", help="Flag to indicate S3 bucket to download from is a requester-pays bucket")
     parser.add_argument("--job-key", dest="job_key", type=str, help="key for job description file to use")
     parser.add_argument("--rerun-failed", dest="try_again", action="store_true", help="flag to allow jobs in failed_runs.txt to be reran on launch")
+    parser.add_argument("--tar-prefix", dest="tar_prefix", type=str, help="outbucket prefix containing only output tars, narrows the completed-output listing")
 
     args = parser.parse_args()
 
@@ -53,7 +54,7 @@ if __name__ == "__main__":
         sys.exit(0)
 
     if args.mode=="cleanup_all":
-        remove_all_inputs()
+        remove_all_inputs(args.inbucket)
         # TODO: Handle logs as well
         sys.exit(0)
 
@@ -68,7 +69,7 @@ if __name__ == "__main__":
     # get list of len batch size of locations and their associated filenames from csv
     # if allow existing (such as for file transfer operations and cost est), this list will
     # not exclude samples which have been completed
-    locations, filenames = resolve_inputs(args.csv_file, args.batch_size, args.outbucket, args.cores_per_inst, prefix,  allow_existing=allow_existing, exclude_failed=exclude_failed, try_again=args.try_again)
+    locations, filenames = resolve_inputs(args.csv_file, args.batch_size, args.outbucket, args.cores_per_inst, prefix,  allow_existing=allow_existing, exclude_failed=exclude_failed, try_again=args.try_again, tar_prefix=args.tar_prefix)
 
     if len(locations) > 0:
         if args.mode in ["download", "download_slurm"]: